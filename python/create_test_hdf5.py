@@ -4,85 +4,198 @@ Generador de archivo HDF5 de prueba para testing de visualización
 Crea matrices grandes simuladas sin consumir memoria masiva
 """
 import os
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import h5py
+from scipy import sparse
 
-def create_test_hdf5(filename, size=60000):
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    import hdf5plugin
+    # Blosc+zstd con bitshuffle: agrupa bits de exponente similares antes de
+    # comprimir, mejorando mucho el ratio en float64 suaves
+    COMPRESSION = dict(hdf5plugin.Blosc(cname='zstd', clevel=5,
+                                        shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+    # Blosc+lz4 para el camino caliente de escritura (matrices masivas)
+    FAST_COMPRESSION = dict(hdf5plugin.Blosc(cname='lz4', clevel=5,
+                                             shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+except ImportError:
+    print("ADVERTENCIA: hdf5plugin no disponible. Usando compresión lzf.")
+    COMPRESSION = {'compression': 'lzf', 'shuffle': True}
+    FAST_COMPRESSION = COMPRESSION
+
+# Generador PCG64 moderno: más rápido que el RandomState global y determinista
+rng = np.random.default_rng(0)
+
+if HAS_NUMBA:
+    @njit(cache=True)
+    def _fill_band_block(i0, j0, out):
+        """Rellenar un bloque banda compilado (serie: el pool de hilos ya
+        reparte los bloques entre cores, y numba parallel=True invocado desde
+        hilos del pool cuelga el intérprete al terminar)"""
+        for bi in range(out.shape[0]):
+            gi = i0 + bi
+            for bj in range(out.shape[1]):
+                d = abs(gi - (j0 + bj))
+                if d <= 50:  # bandwidth = 50
+                    out[bi, bj] = -7e10 * math.exp(-d / 10.0) * 0.3
+                else:
+                    out[bi, bj] = 0.0
+
+def write_stiffness_sparse(matrices_group, size):
+    """Escribir matriz de rigidez banda en formato CSR (datasets 1-D)"""
+    # Matriz banda (bandwidth=50) construida por diagonales: en CSR ocupa
+    # MB frente a los GB del layout denso equivalente
+    offsets = range(-50, 51)
+
+    # Normalizar la banda para que la suma fuera de la diagonal quede por
+    # debajo del mínimo de la diagonal (dominancia estricta): con la banda
+    # completa sin escalar K resulta indefinida y el análisis modal da NaN
+    decay_sum = 2.0 * np.sum(np.exp(-np.arange(1, 51) / 10.0))
+    band_scale = 0.5 * 7e10 * 0.9 / decay_sum
+
+    diagonals = [
+        7e10 * (1.0 + 0.1 * np.sin(np.arange(size) / 1000.0)) if d == 0
+        else np.full(size - abs(d), -band_scale * np.exp(-abs(d) / 10.0))
+        for d in offsets
+    ]
+    K = sparse.diags(diagonals, offsets, format='csr', dtype=np.float32)
+
+    stiff_group = matrices_group.create_group('stiffness')
+    stiff_group.attrs['format'] = 'csr'
+    stiff_group.attrs['shape'] = (size, size)
+    stiff_group.create_dataset('data', data=K.data, **FAST_COMPRESSION)
+    stiff_group.create_dataset('indices', data=K.indices, **FAST_COMPRESSION)
+    stiff_group.create_dataset('indptr', data=K.indptr, **FAST_COMPRESSION)
+
+def write_stiffness_dense(matrices_group, size, chunk_shape, block_size):
+    """Escribir matriz de rigidez densa por bloques (layout Fortran)"""
+    stiff_dataset = matrices_group.create_dataset(
+        'stiffness',
+        shape=(size, size),
+        dtype=np.float32,
+        chunks=chunk_shape,
+        **FAST_COMPRESSION
+    )
+
+    # La escritura HDF5 va serializada (pipeline de filtros mono-hilo);
+    # la generación de bloques sí se reparte entre hilos (NumPy suelta el GIL)
+    write_lock = threading.Lock()
+
+    # Buffers por hilo reutilizados entre bloques: la fase de llenado está
+    # limitada por memoria y cada temporal nuevo duplica el tráfico
+    tls = threading.local()
+
+    def make_and_write_block(i, j):
+        end_i = min(i + block_size, size)
+        end_j = min(j + block_size, size)
+        height, width = end_i - i, end_j - j
+
+        if not hasattr(tls, 'dist'):
+            tls.dist = np.empty((block_size, block_size))
+            tls.mask = np.empty((block_size, block_size), dtype=bool)
+            tls.block = np.empty((block_size, block_size), dtype=np.float32)
+        dist = tls.dist[:height, :width]
+        mask = tls.mask[:height, :width]
+        block = tls.block[:height, :width]
+
+        # Generar bloque con patrón banda (float32: precisión de sobra
+        # para datos de prueba y la mitad de tráfico de memoria)
+        # Diagonal
+        if i == j:
+            block[:] = 0.0
+            np.fill_diagonal(block,
+                             7e10 * (1.0 + 0.1 * np.sin(np.arange(i, end_i) / 1000.0)))
+        # Bandas cercanas: kernel compilado si hay numba, si no NumPy in situ
+        elif abs(i - j) <= block_size:
+            if HAS_NUMBA:
+                _fill_band_block(i, j, block)
+            else:
+                np.subtract(np.arange(i, end_i)[:, None], np.arange(j, end_j)[None, :],
+                            out=dist)
+                np.abs(dist, out=dist)
+                np.less_equal(dist, 50, out=mask)  # bandwidth = 50
+                np.divide(dist, -10.0, out=dist)
+                np.exp(dist, out=dist)
+                np.multiply(dist, -7e10 * 0.3, out=block)
+                block *= mask  # fuera de la banda → 0
+        else:
+            block[:] = 0.0
+
+        with write_lock:
+            stiff_dataset[i:end_i, j:end_j] = block
+
+    # Solo los bloques que pasan el predicado de banda: los demás quedan
+    # en cero (fill value HDF5), evitando ~99% de las escrituras de chunks
+    pairs = [(i, j)
+             for i in range(0, size, block_size)
+             for j in range(0, size, block_size)
+             if abs(i - j) < block_size * 2]
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        for future in [pool.submit(make_and_write_block, i, j) for i, j in pairs]:
+            future.result()
+
+def create_test_hdf5(filename, size=60000, dense=False):
     """Crear archivo HDF5 de prueba con datos simulados grandes"""
     print(f"📦 Creando archivo HDF5 de prueba: {filename}")
-    print(f"   Tamaño simulado: {size}x{size} ({size*size*8/(1024**3):.1f} GB)")
+    print(f"   Tamaño simulado: {size}x{size} ({size*size*4/(1024**3):.1f} GB)")
 
     # Crear directorio si no existe
     os.makedirs(os.path.dirname(filename), exist_ok=True)
 
-    with h5py.File(filename, 'w') as f:
+    # Chunks de ~1 MB (512x512 float32) y caché de chunks amplia para que
+    # el llenado por bloques no expulse chunks entre escrituras
+    chunk_shape = (min(512, size), min(512, size))
+
+    with h5py.File(filename, 'w', rdcc_nbytes=64*1024*1024, rdcc_nslots=10007) as f:
         # Crear grupos
         matrices_group = f.create_group('matrices')
         vectors_group = f.create_group('vectors')
         results_group = f.create_group('results')
 
-        print("   🔨 Generando matriz de rigidez simulada...")
-        # Crear matriz de rigidez sparse simulada
-        stiff_dataset = matrices_group.create_dataset(
-            'stiffness',
-            shape=(size, size),
-            dtype=np.float64,
-            compression='gzip',
-            compression_opts=6,
-            chunks=(min(1000, size//10), min(1000, size//10))
-        )
+        block_size = 1024  # múltiplo del ancho de chunk (512)
 
-        # Llenar por bloques para evitar memoria masiva
-        block_size = 1000
-        for i in range(0, size, block_size):
-            end_i = min(i + block_size, size)
-            for j in range(0, size, block_size):
-                end_j = min(j + block_size, size)
-
-                # Generar bloque con patrón banda
-                block = np.zeros((end_i - i, end_j - j))
-                if abs(i - j) < block_size * 2:  # Solo llenar cerca de la diagonal
-                    # Diagonal
-                    if i == j:
-                        np.fill_diagonal(block,
-                                         7e10 * (1.0 + 0.1 * np.sin(np.arange(i, end_i) / 1000.0)))
-                    # Bandas cercanas
-                    elif abs(i - j) <= block_size:
-                        for bi in range(block.shape[0]):
-                            for bj in range(block.shape[1]):
-                                if abs((i + bi) - (j + bj)) <= 50:  # bandwidth = 50
-                                    dist = abs((i + bi) - (j + bj))
-                                    block[bi, bj] = -7e10 * np.exp(-dist/10.0) * 0.3
-
-                stiff_dataset[i:end_i, j:end_j] = block
+        print("   🔨 Generando matriz de rigidez simulada...")
+        if dense:
+            # Layout denso (N,N) compatible con las herramientas Fortran
+            write_stiffness_dense(matrices_group, size, chunk_shape, block_size)
+        else:
+            write_stiffness_sparse(matrices_group, size)
 
         print("   ⚖️ Generando matriz de masa simulada...")
         # Crear matriz de masa diagonal
         mass_dataset = matrices_group.create_dataset(
             'mass',
             shape=(size, size),
-            dtype=np.float64,
-            compression='gzip',
-            compression_opts=6,
-            chunks=(min(1000, size//10), min(1000, size//10))
+            dtype=np.float32,
+            chunks=chunk_shape,
+            **FAST_COMPRESSION
         )
 
-        # Llenar matriz de masa (diagonal)
+        # Llenar matriz de masa (solo los bloques diagonales, sin filas densas)
         for i in range(0, size, block_size):
             end_i = min(i + block_size, size)
-            block = np.zeros((end_i - i, size))
-            np.fill_diagonal(block[:, i:end_i], 0.054)  # kg por DOF
-            mass_dataset[i:end_i, :] = block
+            # 0.054 kg por DOF
+            mass_dataset[i:end_i, i:end_i] = np.eye(end_i - i, dtype=np.float32) * np.float32(0.054)
 
         print("   🔧 Generando vectores simulados...")
         # Vector de fuerzas
-        force = np.random.normal(0, 1000, size)  # Fuerzas aleatorias ±1000N
-        vectors_group.create_dataset('force', data=force, compression='gzip', compression_opts=6)
+        force = rng.standard_normal(size, dtype=np.float32)
+        force *= 1000  # Fuerzas aleatorias ±1000N
+        vectors_group.create_dataset('force', data=force, **COMPRESSION)
 
         # Vector de desplazamientos
-        displacement = np.random.normal(0, 1e-6, size)  # Desplazamientos pequeños
-        results_group.create_dataset('displacement', data=displacement, compression='gzip',
-                                     compression_opts=6)
+        displacement = rng.standard_normal(size, dtype=np.float32)
+        displacement *= 1e-6  # Desplazamientos pequeños
+        results_group.create_dataset('displacement', data=displacement, **COMPRESSION)
 
         print("   📋 Añadiendo metadatos...")
         # Metadatos
@@ -95,7 +208,7 @@ def create_test_hdf5(filename, size=60000):
 
     # Mostrar tamaño real del archivo
     file_size_mb = os.path.getsize(filename) / (1024**2)
-    compression_ratio = size*size*8/(1024**2)/file_size_mb
+    compression_ratio = size*size*4/(1024**2)/file_size_mb
     print(f"   📦 Tamaño real archivo: {file_size_mb:.1f} MB "
           f"(compresión ~{compression_ratio:.1f}x)")
 
@@ -111,20 +224,22 @@ def create_small_test_hdf5(filename, size=5000):
         results_group = f.create_group('results')
 
         # Matrices pequeñas completas
-        K = np.random.rand(size, size) * 1e10
+        K = rng.random((size, size), dtype=np.float32)
+        K *= 1e10
         K = (K + K.T) / 2  # Simétrica
-        np.fill_diagonal(K, np.diag(K) + 7e10)  # Diagonal dominante
+        np.fill_diagonal(K, np.diag(K) + np.float32(7e10))  # Diagonal dominante
 
-        M = np.eye(size) * 0.054  # Masa diagonal
+        M = np.eye(size, dtype=np.float32) * np.float32(0.054)  # Masa diagonal
 
-        force = np.random.normal(0, 1000, size)
-        displacement = np.random.normal(0, 1e-6, size)
+        force = rng.standard_normal(size, dtype=np.float32)
+        force *= 1000
+        displacement = rng.standard_normal(size, dtype=np.float32)
+        displacement *= 1e-6
 
-        matrices_group.create_dataset('stiffness', data=K, compression='gzip', compression_opts=6)
-        matrices_group.create_dataset('mass', data=M, compression='gzip', compression_opts=6)
-        vectors_group.create_dataset('force', data=force, compression='gzip', compression_opts=6)
-        results_group.create_dataset('displacement', data=displacement, compression='gzip',
-                                     compression_opts=6)
+        matrices_group.create_dataset('stiffness', data=K, **COMPRESSION)
+        matrices_group.create_dataset('mass', data=M, **COMPRESSION)
+        vectors_group.create_dataset('force', data=force, **COMPRESSION)
+        results_group.create_dataset('displacement', data=displacement, **COMPRESSION)
 
         f.attrs['description'] = 'Archivo pequeño de prueba'
         f.attrs['size'] = size
@@ -138,6 +253,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Crear archivos HDF5 de prueba')
     parser.add_argument('--size', type=int, default=60000, help='Tamaño de matriz (default: 60000)')
     parser.add_argument('--small', action='store_true', help='Crear archivo pequeño (5000x5000)')
+    parser.add_argument('--dense', action='store_true',
+                        help='Guardar rigidez densa (layout Fortran) en vez de CSR')
     parser.add_argument('--output', default='results/test_matrices.h5', help='Archivo de salida')
 
     args = parser.parse_args()
@@ -145,4 +262,4 @@ if __name__ == "__main__":
     if args.small:
         create_small_test_hdf5(args.output, 5000)
     else:
-        create_test_hdf5(args.output, args.size)
+        create_test_hdf5(args.output, args.size, dense=args.dense)
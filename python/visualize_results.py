@@ -8,6 +8,8 @@ import argparse
 from typing import Optional, Dict, Any
 
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # Backend sin GUI: render por lotes más rápido
 import matplotlib.pyplot as plt
 
 try:
@@ -24,7 +26,19 @@ except ImportError:
     exit(1)
 
 try:
-    from scipy.sparse import csr_matrix
+    import hdf5plugin  # noqa: F401  # Registra los filtros Blosc para lectura
+except ImportError:
+    print("ADVERTENCIA: hdf5plugin no disponible. "
+          "Archivos comprimidos con Blosc no se podrán leer.")
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    from scipy.sparse import csr_matrix, issparse
     from scipy.sparse.linalg import eigsh
 except ImportError:
     print("ADVERTENCIA: scipy no está instalado. Análisis modal deshabilitado.")
@@ -32,6 +46,18 @@ except ImportError:
     csr_matrix = None
     eigsh = None
 
+    def issparse(_matrix):
+        return False
+
+# Caché de chunks amplia para lecturas con paso (submuestreo): tocan muchos
+# chunks por fila y la caché por defecto (1 MB) los expulsa y descomprime
+# una y otra vez
+HDF5_CACHE_OPTS = {
+    'rdcc_nbytes': 256 * 1024 * 1024,
+    'rdcc_nslots': 100003,
+    'rdcc_w0': 0.75,
+}
+
 # Configuración de estilo
 if HAS_SEABORN:
     plt.style.use('seaborn-v0_8-darkgrid')
@@ -57,15 +83,47 @@ def load_dataset_with_subsampling(
     n = dataset.shape[0]
     if n > max_size:
         step = n // max_size
+        n_out = (n + step - 1) // step
         if is_vector:
             print(f"   📉 Submuestreando {dataset_path}: {n} → {max_size} (paso={step})")
-            return dataset[::step]  # type: ignore
+            # Buffer preasignado + read_direct: evita la copia intermedia de h5py
+            out = np.empty(n_out, dtype=dataset.dtype)
+            dataset.read_direct(out, source_sel=np.s_[::step])
         else:
             print(f"   📉 Submuestreando {dataset_path}: {n}x{n} → "
                   f"{max_size}x{max_size} (paso={step})")
-            return dataset[::step, ::step]  # type: ignore
+            out = np.empty((n_out, n_out), dtype=dataset.dtype)
+            dataset.read_direct(out, source_sel=np.s_[::step, ::step])
+        return out
     else:
-        return dataset[:]  # type: ignore
+        out = np.empty(dataset.shape, dtype=dataset.dtype)
+        dataset.read_direct(out)
+        return out
+
+def load_sparse_matrix(
+    hdf5_file: h5py.File,
+    group_path: str,
+    max_size: int
+) -> Optional[Any]:
+    """Cargar matriz CSR guardada como datasets 1-D indptr/indices/data"""
+    if csr_matrix is None:
+        print(f"   ⚠️ ERROR: {group_path} es CSR pero scipy no está disponible")
+        return None
+
+    group = hdf5_file[group_path]
+    shape = tuple(group.attrs['shape'])
+    matrix = csr_matrix(
+        (group['data'][:], group['indices'][:], group['indptr'][:]),
+        shape=shape
+    )
+
+    n = shape[0]
+    if n > max_size:
+        step = n // max_size
+        print(f"   📉 Submuestreando {group_path}: {n}x{n} → "
+              f"{max_size}x{max_size} (paso={step})")
+        matrix = matrix[::step, ::step]
+    return matrix
 
 def load_hdf5_data(filename: str, max_size: int = 5000) -> Optional[Dict[str, Any]]:
     """Cargar datos desde el archivo HDF5 con submuestreo automático para matrices grandes"""
@@ -78,7 +136,7 @@ def load_hdf5_data(filename: str, max_size: int = 5000) -> Optional[Dict[str, An
 
     data = {}
     try:
-        with h5py.File(filename, 'r') as f:
+        with h5py.File(filename, 'r', **HDF5_CACHE_OPTS) as f:
             print("📊 Datasets encontrados:")
 
             # Listar todos los datasets recursivamente
@@ -88,9 +146,13 @@ def load_hdf5_data(filename: str, max_size: int = 5000) -> Optional[Dict[str, An
             f.visititems(print_structure)
 
             # Cargar matrices con submuestreo inteligente
-            stiffness = load_dataset_with_subsampling(
-                f, '/matrices/stiffness', max_size, is_vector=False
-            )
+            # (la rigidez puede estar en layout denso o CSR)
+            if isinstance(f.get('/matrices/stiffness'), h5py.Group):
+                stiffness = load_sparse_matrix(f, '/matrices/stiffness', max_size)
+            else:
+                stiffness = load_dataset_with_subsampling(
+                    f, '/matrices/stiffness', max_size, is_vector=False
+                )
             if stiffness is not None:
                 data['stiffness'] = stiffness
                 print(f"   ✅ Matriz de rigidez cargada: {data['stiffness'].shape}")
@@ -118,8 +180,13 @@ def load_hdf5_data(filename: str, max_size: int = 5000) -> Optional[Dict[str, An
 
     return data
 
-def plot_matrix_structure(matrix: np.ndarray, title: str, subplot_pos: int, fig) -> None:
-    """Visualizar estructura de sparsity de una matriz (optimizado para memoria)"""
+def plot_matrix_structure(matrix: Any, title: str, subplot_pos: int, fig) -> None:
+    """Visualizar estructura de sparsity de una matriz (optimizado para memoria)
+
+    Acepta ndarray, matriz sparse o h5py.Dataset: con un dataset el
+    submuestreo se resuelve como hyperslab HDF5 y la matriz completa
+    nunca se materializa en RAM.
+    """
     ax = fig.add_subplot(subplot_pos)
 
     # Protección extrema de memoria - máximo 300x300 para visualización
@@ -129,11 +196,21 @@ def plot_matrix_structure(matrix: np.ndarray, title: str, subplot_pos: int, fig)
         matrix_plot = matrix[::step, ::step]
         print(f"   🔍 Submuestreo para visualización: {n}x{n} → {matrix_plot.shape}")
     else:
-        matrix_plot = matrix
+        matrix_plot = matrix[:]
+
+    # Densificar solo la vista submuestreada (máx. 300x300)
+    if issparse(matrix_plot):
+        matrix_plot = matrix_plot.toarray()
 
     # Crear máscara de elementos no-cero (más eficiente)
     abs_matrix = np.abs(matrix_plot)
-    threshold = np.percentile(abs_matrix[abs_matrix > 0], 10) if np.any(abs_matrix > 0) else 0
+    nonzeros = abs_matrix[abs_matrix > 0]
+    if nonzeros.size:
+        # Selección O(N) del percentil 10 en lugar de ordenar/interpolar
+        k = nonzeros.size // 10
+        threshold = np.partition(nonzeros, k)[k]
+    else:
+        threshold = 0
     nonzero_mask = abs_matrix > threshold
 
     # Visualizar
@@ -148,6 +225,26 @@ def plot_matrix_structure(matrix: np.ndarray, title: str, subplot_pos: int, fig)
             transform=ax.transAxes, verticalalignment='top',
             bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
 
+def _bandwidth_row(row):
+    """Ancho de banda de una fila: máximo, umbral y barrido en una pasada"""
+    m = 0.0
+    for k in range(row.size):
+        a = abs(row[k])
+        if a > m:
+            m = a
+    thr = m * 1e-10
+    first = -1
+    last = -1
+    for k in range(row.size):
+        if abs(row[k]) > thr:
+            if first < 0:
+                first = k
+            last = k
+    return last - first + 1 if first >= 0 else 0
+
+if HAS_NUMBA:
+    _bandwidth_row = njit(cache=True)(_bandwidth_row)
+
 def estimate_bandwidth(matrix):
     """Estimar ancho de banda de la matriz"""
     n = matrix.shape[0]
@@ -156,14 +253,13 @@ def estimate_bandwidth(matrix):
     # Comprobar solo las primeras 100 filas para eficiencia
     for i in range(min(100, n)):
         row = matrix[i, :]
-        nonzeros = np.where(np.abs(row) > np.max(np.abs(row)) * 1e-10)[0]
-        if len(nonzeros) > 0:
-            band = np.max(nonzeros) - np.min(nonzeros) + 1
-            max_band = max(max_band, band)
+        if issparse(row):
+            row = row.toarray().ravel()
+        max_band = max(max_band, _bandwidth_row(np.ascontiguousarray(row)))
 
     return min(max_band, n)
 
-def plot_eigenvalue_analysis(stiffness, mass):
+def plot_eigenvalue_analysis(stiffness, mass, dpi: int = 150):
     """Análisis de valores propios (modal analysis)"""
     print("🔍 Realizando análisis modal...")
 
@@ -177,13 +273,19 @@ def plot_eigenvalue_analysis(stiffness, mass):
         K = stiffness
         M = mass
 
+    # Promover a float64 localmente: los datos pueden venir en float32
+    # y el eigensolver agradece la precisión extra
+    K = K.astype(np.float64)
+    M = M.astype(np.float64)
+
     try:
-        # Convertir a sparse para eficiencia
-        K_sparse = csr_matrix(K)
-        M_sparse = csr_matrix(M)
+        # eigsh acepta matrices sparse y densas: mantener CSR si ya viene
+        # dispersa y no escanear el bloque denso para reconstruirla
+        K_op = K.tocsr() if issparse(K) else K
+        M_op = M.tocsr() if issparse(M) else M
 
         # Calcular primeros modos
-        eigenvals, eigenvecs = eigsh(K_sparse, k=6, M=M_sparse, which='SM')
+        eigenvals, eigenvecs = eigsh(K_op, k=6, M=M_op, which='SM')
         frequencies = np.sqrt(np.real(eigenvals)) / (2 * np.pi)
 
         _, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 5))
@@ -208,7 +310,8 @@ def plot_eigenvalue_analysis(stiffness, mass):
         ax2.grid(True, alpha=0.3)
 
         plt.tight_layout()
-        plt.savefig('results/modal_analysis.png', dpi=300, bbox_inches='tight')
+        plt.savefig('results/modal_analysis.png', dpi=dpi, bbox_inches='tight')
+        plt.close()
         print("   ✅ Análisis modal guardado en: results/modal_analysis.png")
 
         # Imprimir resumen
@@ -219,35 +322,33 @@ def plot_eigenvalue_analysis(stiffness, mass):
     except (ImportError, ValueError, RuntimeError) as e:
         print(f"⚠️  Error en análisis modal: {e}")
 
-def plot_response_analysis(force, displacement):
+def plot_response_analysis(force, displacement, dpi: int = 150):
     """Análisis de la respuesta estructural"""
     _, axes = plt.subplots(2, 2, figsize=(14, 10))
 
     n_nodes = len(force) // 6  # Asumiendo 6 DOF por nodo
     node_positions = np.arange(n_nodes)
 
-    # Reorganizar por componentes (X, Y, Z, RX, RY, RZ)
-    disp_x = displacement[0::6][:n_nodes]
-    disp_y = displacement[1::6][:n_nodes] if len(displacement) > 1 else np.zeros_like(disp_x)
-    disp_z = displacement[2::6][:n_nodes] if len(displacement) > 2 else np.zeros_like(disp_x)
+    # Reorganizar por componentes (X, Y, Z, RX, RY, RZ): un solo reshape 2-D
+    # en lugar de seis slicings con paso 6
+    disp_comp = np.asarray(displacement[:n_nodes * 6]).reshape(n_nodes, 6)
+    force_comp = np.asarray(force[:n_nodes * 6]).reshape(n_nodes, 6)
 
-    force_x = force[0::6][:n_nodes]
-    force_y = force[1::6][:n_nodes] if len(force) > 1 else np.zeros_like(force_x)
+    disp_x, disp_y, disp_z = disp_comp[:, 0], disp_comp[:, 1], disp_comp[:, 2]
+    force_x, force_y = force_comp[:, 0], force_comp[:, 1]
 
     # Desplazamientos por componente
     axes[0,0].plot(node_positions, disp_x * 1000, 'r-', label='X', linewidth=2)
-    if len(displacement) > 1:
-        axes[0,0].plot(node_positions, disp_y * 1000, 'g-', label='Y', linewidth=2)
-    if len(displacement) > 2:
-        axes[0,0].plot(node_positions, disp_z * 1000, 'b-', label='Z', linewidth=2)
+    axes[0,0].plot(node_positions, disp_y * 1000, 'g-', label='Y', linewidth=2)
+    axes[0,0].plot(node_positions, disp_z * 1000, 'b-', label='Z', linewidth=2)
     axes[0,0].set_xlabel('Nodo')
     axes[0,0].set_ylabel('Desplazamiento (mm)')
     axes[0,0].set_title('Desplazamientos por Componente')
     axes[0,0].legend()
     axes[0,0].grid(True, alpha=0.3)
 
-    # Magnitud del desplazamiento
-    disp_magnitude = np.sqrt(disp_x**2 + disp_y**2 + disp_z**2)
+    # Magnitud del desplazamiento (norma por filas sobre X, Y, Z)
+    disp_magnitude = np.linalg.norm(disp_comp[:, :3], axis=1)
     axes[0,1].plot(node_positions, disp_magnitude * 1000, 'purple', linewidth=2)
     axes[0,1].set_xlabel('Nodo')
     axes[0,1].set_ylabel('|Desplazamiento| (mm)')
@@ -256,8 +357,7 @@ def plot_response_analysis(force, displacement):
 
     # Fuerzas aplicadas
     axes[1,0].plot(node_positions, force_x / 1000, 'orange', linewidth=2, label='Fx')
-    if len(force) > 1:
-        axes[1,0].plot(node_positions, force_y / 1000, 'brown', linewidth=2, label='Fy')
+    axes[1,0].plot(node_positions, force_y / 1000, 'brown', linewidth=2, label='Fy')
     axes[1,0].set_xlabel('Nodo')
     axes[1,0].set_ylabel('Fuerza (kN)')
     axes[1,0].set_title('Fuerzas Aplicadas')
@@ -277,7 +377,8 @@ def plot_response_analysis(force, displacement):
     axes[1,1].grid(True, alpha=0.3)
 
     plt.tight_layout()
-    plt.savefig('results/response_analysis.png', dpi=300, bbox_inches='tight')
+    plt.savefig('results/response_analysis.png', dpi=dpi, bbox_inches='tight')
+    plt.close()
     print("   ✅ Análisis de respuesta guardado en: results/response_analysis.png")
 
 def generate_report(data):
@@ -287,46 +388,39 @@ def generate_report(data):
 
     if 'stiffness' in data:
         K = data['stiffness']
+        diag_k = K.diagonal()
+        nnz = K.count_nonzero() if issparse(K) else np.count_nonzero(K)
         print("🔧 MATRIZ DE RIGIDEZ:")
         print(f"   Dimensiones: {K.shape}")
-        print(f"   Valores diagonal: {np.min(np.diag(K)):.2e} - {np.max(np.diag(K)):.2e}")
-        print(f"   Número condición aprox: {np.max(np.diag(K))/np.min(np.diag(K)):.2e}")
-        print(f"   Sparsity: {100*(1-np.count_nonzero(K)/K.size):.1f}%")
-
-    if 'mass' in data:
-        M = data['mass']
-        print("\n⚖️  MATRIZ DE MASA:")
-        print(f"   Dimensiones: {M.shape}")
-        print(f"   Masa total: {np.sum(np.diag(M)):.2f} kg")
-        print(f"   Masa por DOF: {np.mean(np.diag(M)):.4f} kg")
-
-    if 'force' in data and 'displacement' in data:
-        F = data['force']
-        U = data['displacement']
-        print("\n🏗️  RESPUESTA ESTRUCTURAL:")
+        print(f"   Valores diagonal: {np.min(diag_k):.2e} - {np.max(diag_k):.2e}")
+        print(f"   Número condición aprox: {np.max(diag_k)/np.min(diag_k):.2e}")
+        print(f"   Sparsity: {100*(1-nnz/(K.shape[0]*K.shape[1])):.1f}%")
 
     if 'mass' in data:
         M = data['mass']
+        diag_m = np.diag(M)
         print("\n⚖️  MATRIZ DE MASA:")
         print(f"   Dimensiones: {M.shape}")
-        print(f"   Masa total: {np.sum(np.diag(M)):.2f} kg")
-        print(f"   Masa por DOF: {np.mean(np.diag(M)):.4f} kg")
+        print(f"   Masa total: {np.sum(diag_m):.2f} kg")
+        print(f"   Masa por DOF: {np.mean(diag_m):.4f} kg")
 
     if 'force' in data and 'displacement' in data:
         F = data['force']
         U = data['displacement']
+        abs_u = np.abs(U)
+        max_disp_mm = np.max(abs_u) * 1000
         print("\n🏗️  RESPUESTA ESTRUCTURAL:")
         print(f"   Fuerza total: {np.sum(np.abs(F)):.2e} N")
-        print(f"   Desplazamiento máximo: {np.max(np.abs(U))*1000:.4f} mm")
+        print(f"   Desplazamiento máximo: {max_disp_mm:.4f} mm")
         print(f"   Desplazamiento RMS: {np.sqrt(np.mean(U**2))*1000:.4f} mm")
 
-        # Energía de deformación
+        # Energía de deformación (K @ U primero: evita el producto N x N)
         if 'stiffness' in data:
-            energy = 0.5 * np.dot(U, np.dot(K, U))
+            k_u = K @ U
+            energy = 0.5 * np.dot(U, k_u)
             print(f"   Energía deformación: {energy:.2e} J")
 
         # Verificar límites
-        max_disp_mm = np.max(np.abs(U)) * 1000
         if max_disp_mm > 10:
             print(f"   ⚠️  ADVERTENCIA: Desplazamiento {max_disp_mm:.2f} mm > 10 mm")
         else:
@@ -345,6 +439,8 @@ def main():
                         help='Tamaño máximo de matriz para submuestreo (default: 2000)')
     parser.add_argument('--quick', action='store_true',
                         help='Modo rápido: submuestreo agresivo para matrices grandes')
+    parser.add_argument('--dpi', type=int, default=150,
+                        help='Resolución de los PNG (default: 150; usa 300 para publicación)')
 
     args = parser.parse_args()
 
@@ -382,26 +478,35 @@ def main():
 
         # Análisis de respuesta
         if 'force' in data and 'displacement' in data:
-            plot_response_analysis(data['force'], data['displacement'])
+            plot_response_analysis(data['force'], data['displacement'], dpi=args.dpi)
 
-        # Estructura de matrices
+        # Estructura de matrices: los datasets densos se plotean directamente
+        # desde el archivo (hyperslabs), sin pasar por la copia submuestreada
         if 'stiffness' in data or 'mass' in data:
             fig = plt.figure(figsize=(14, 6))
 
-            if 'stiffness' in data:
-                plot_matrix_structure(data['stiffness'], 'Matriz de Rigidez', 121, fig)
+            with h5py.File(args.file, 'r', **HDF5_CACHE_OPTS) as f:
+                stiffness = f.get('/matrices/stiffness')
+                if isinstance(stiffness, h5py.Dataset):
+                    plot_matrix_structure(stiffness, 'Matriz de Rigidez', 121, fig)
+                elif 'stiffness' in data:
+                    plot_matrix_structure(data['stiffness'], 'Matriz de Rigidez', 121, fig)
 
-            if 'mass' in data:
-                plot_matrix_structure(data['mass'], 'Matriz de Masa', 122, fig)
+                mass = f.get('/matrices/mass')
+                if isinstance(mass, h5py.Dataset):
+                    plot_matrix_structure(mass, 'Matriz de Masa', 122, fig)
+                elif 'mass' in data:
+                    plot_matrix_structure(data['mass'], 'Matriz de Masa', 122, fig)
 
             plt.tight_layout()
-            plt.savefig('results/matrix_structure.png', dpi=300, bbox_inches='tight')
+            plt.savefig('results/matrix_structure.png', dpi=args.dpi, bbox_inches='tight')
+            plt.close(fig)
             print("   ✅ Estructura de matrices guardada en: results/matrix_structure.png")
 
         # Análisis modal
         if args.modal and 'stiffness' in data and 'mass' in data:
             if eigsh is not None:
-                plot_eigenvalue_analysis(data['stiffness'], data['mass'])
+                plot_eigenvalue_analysis(data['stiffness'], data['mass'], dpi=args.dpi)
             else:
                 print("   ⚠️  Análisis modal omitido (scipy no disponible)")
 